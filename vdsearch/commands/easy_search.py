@@ -1,12 +1,14 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import subprocess
 import logging
+import os
 import shutil
 from pathlib import Path
+from typing import Dict, Tuple
 
 import rich_click as click
 import pandas as pd
 from pkg_resources import resource_filename  # type: ignore
-import rich
 import skbio
 import typer
 from rich.console import Console
@@ -24,6 +26,24 @@ from vdsearch.nim import write_seqs as ws
 from vdsearch.types import FASTA, ReferenceCms, Threads, ViroidDB
 from vdsearch.utils import check_executable_exists
 
+# cmsearch stops scaling past a handful of workers, so the rest are left to MMseqs
+CMSEARCH_MAX_THREADS = 4
+
+
+def _split_threads(threads: int) -> Tuple[int, int]:
+    """Split one thread budget between cmsearch and MMseqs running side by side.
+
+    cmsearch gets half the budget, up to CMSEARCH_MAX_THREADS, and MMseqs gets the rest.
+    Neither share shrinks as the budget grows.
+    """
+    cm_threads = min(CMSEARCH_MAX_THREADS, max(1, threads // 2))
+    mmseqs_threads = max(1, threads - cm_threads)
+    logging.debug(
+        f"Splitting {threads} threads: {cm_threads} for cmsearch, "
+        f"{mmseqs_threads} for MMseqs."
+    )
+    return cm_threads, mmseqs_threads
+
 
 def easy_search(
     fasta: Path = FASTA,
@@ -150,35 +170,75 @@ def easy_search(
         logging.warning("CircRNAs already deduplicated. Skipping.")
     # endregion
 
-    # region: run infernal
+    # region: search the deduplicated circRNAs
+    # Infernal, RNAmotif, and the ViroidDB search only depend on the deduplicated
+    # circRNAs, so run them side by side. Each one is a subprocess, so threads are
+    # enough to overlap them. Note that --threads is a single budget shared between
+    # cmsearch and MMseqs while both run.
     cmsearch_output = outdir / "infernal.out"
     cmsearch_tblout = outdir / "infernal.tblout"
-    if not cmsearch_output.exists() or not cmsearch_tblout.exists():
-        infernal(
-            deduped_circs,
-            output=cmsearch_output,
-            output_tsv=cmsearch_tblout,
-            reference_cms=reference_cms,
-            threads=threads,
-            cmscan=False,
-        )
-    else:
-        logging.warning("Infernal already run. Skipping.")
-    # endregion
-
-    # region: run rnamotif if possible
     rnamotif_output = outdir / "rnamotif.tsv"
-    if not rnamotif_output.exists():
-        try:
-            rnamotif(
+    viroiddb_hits = outdir / "search_vs_viroiddb.tsv"
+    # MMseqs only shares the thread budget with cmsearch when Infernal actually runs
+    mmseqs_threads = threads
+    pool = ThreadPoolExecutor(max_workers=3)
+    futures: Dict[Future, str] = {}
+    try:
+        if not cmsearch_output.exists() or not cmsearch_tblout.exists():
+            cm_threads, mmseqs_threads = _split_threads(threads)
+            infernal_future = pool.submit(
+                infernal,
+                deduped_circs,
+                output=cmsearch_output,
+                output_tsv=cmsearch_tblout,
+                reference_cms=reference_cms,
+                threads=cm_threads,
+                cmscan=False,
+            )
+            futures[infernal_future] = "Infernal"
+        else:
+            logging.warning("Infernal already run. Skipping.")
+
+        if not rnamotif_output.exists():
+            rnamotif_future = pool.submit(
+                rnamotif,
                 deduped_circs,
-                Path(resource_filename("vdsearch", "data/rnamotif/Hammerhead_3.descr")),
+                Path(
+                    resource_filename("vdsearch", "data/rnamotif/Hammerhead_3.descr")
+                ),
                 rnamotif_output,
             )
-        except Exception:
-            logging.warn("Could not run RNAmotif. Skipping.")
-    else:
-        logging.warning("RNAmotif already run. Skipping.")
+            futures[rnamotif_future] = "RNAmotif"
+        else:
+            logging.warning("RNAmotif already run. Skipping.")
+
+        if not viroiddb_hits.exists():
+            search_future = pool.submit(
+                search,
+                deduped_circs,
+                reference_db,
+                output_tsv=viroiddb_hits,
+                threads=mmseqs_threads,
+            )
+            futures[search_future] = "MMseqs"
+
+        # handle each search as soon as it finishes so a failure surfaces right away
+        # instead of after the slowest search
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    continue
+                if futures[future] == "RNAmotif":
+                    logging.warn("Could not run RNAmotif. Skipping.")
+                    continue
+                logging.error(f"{futures[future]} failed. Stopping easy-search.")
+                raise error
+    finally:
+        # don't block on the searches still running if one of them failed
+        pool.shutdown(wait=False)
     # endregion
 
     # region: find the viroids in the infernal output
@@ -196,19 +256,13 @@ def easy_search(
         ws.write_seqs(
             str(deduped_circs),
             str(rz_seqs),
-            ribozymes["ribozy_likes"].seq_id.tolist(),
+            ribozymes["df"].loc[ribozymes["ribozy_mask"], "seq_id"].unique().tolist(),
         )
         logging.done(f"Wrote to {rz_seqs}")  # type: ignore
     else:
         logging.warning("Viroid-like sequences already found. Skipping.")
     # endregion
 
-    # region: search against ViroidDB
-    viroiddb_hits = outdir / "search_vs_viroiddb.tsv"
-    if not viroiddb_hits.exists():
-        search(deduped_circs, reference_db, output_tsv=viroiddb_hits, threads=threads)
-    # endregion
-
     # region: extract the viroid matches from ViroidDB
     seqs_matching_viroiddb = outdir / "seqs_matching_viroiddb.fasta"
     if not seqs_matching_viroiddb.exists():
@@ -223,7 +277,7 @@ def easy_search(
         ws.write_seqs(
             str(deduped_circs),
             str(seqs_matching_viroiddb),
-            search_results["query"].tolist(),
+            search_results["query"].unique().tolist(),
         )
         logging.done(f"Wrote to {seqs_matching_viroiddb}")  # type: ignore
     else:
@@ -319,27 +373,37 @@ def easy_search(
     # endregion
 
     # logging.done(f"The results are in [green bold]{fasta.stem}_viroidlikes.fasta.[/]")  # type: ignore
-    Console().log(
-        # "\n",
-        # "Thanks for using [green]vdsearch[/]!",
-        "\n",
-        rich.panel.Panel(
-            rich.markdown.Markdown(
-                """
+    # the citation panel is only worth rendering for someone watching a terminal
+    console = Console()
+    if console.is_terminal and not os.environ.get("VDSEARCH_QUIET"):
+        from rich.markdown import Markdown
+        from rich.panel import Panel
+
+        console.log(
+            # "\n",
+            # "Thanks for using [green]vdsearch[/]!",
+            "\n",
+            Panel(
+                Markdown(
+                    """
 If you use these results in your research, please cite:
 
 > B.D. Lee *et al.* (2022) vdsearch: A tool for viroid-like RNA searches.
             """
+                ),
+                title_align="left",
+                border_style="dim",
+                width=88,
+                title="Citation",
             ),
-            title_align="left",
-            border_style="dim",
-            width=88,
-            title="Citation",
-        ),
-        "\n",
-        "[dim]Brought to you by: [cyan bold]NIH/NLM/NCBI[/], [blue bold]University of Oxford[/], and [bold]Tel Aviv University[/][/dim]",
-        "\n",
-    )
+            "\n",
+            "[dim]Brought to you by: [cyan bold]NIH/NLM/NCBI[/], [blue bold]University of Oxford[/], and [bold]Tel Aviv University[/][/dim]",
+            "\n",
+        )
+    else:
+        logging.info(
+            "Citation: B.D. Lee et al. (2022) vdsearch: A tool for viroid-like RNA searches."
+        )
 
     # remove the lock
     lockfile.unlink()
@@ -1,14 +1,24 @@
 from enum import Enum
+import functools
 import logging
+import mmap
 from pathlib import Path
-from typing import Dict, Literal, Optional
+import re
+from typing import IO, Any, Dict, Literal, Optional, Union
 
+import numpy as np
 import pandas as pd
 import typer
 
 from vdsearch.types import ReferenceCms
 
 
+# matches the start of each CM record as well as the name and cutoff lines within it
+_CM_FIELD_PATTERN = re.compile(
+    rb"^(?:(INFERNAL)|NAME[ \t]+(\S+)|(GA|TC|NC)[ \t]+(\S+))", re.MULTILINE
+)
+
+
 class CmCutoffType(str, Enum):
     GA = "GA"
     NC = "NC"
@@ -26,19 +36,42 @@ def parse_cm_file(path: Path) -> Dict[str, Dict[str, float]]:
             'NC': 32.3,
     }
     `
+
+    Results are cached per process, keyed on the file's resolved path and
+    modification time, so the same CM file is only parsed once.
     """
-    cutoffs = {}
-
-    with path.open() as f:
-        last_name = ""
-        last_cutoff = {
-            "GA": 0.0,
-            "TC": 0.0,
-            "NC": 0.0,
-        }
-
-        for line in f:
-            if "INFERNAL" in line:
+    stat = path.stat()
+    cutoffs = _parse_cm_file_cached(
+        str(path.resolve()), stat.st_mtime_ns, stat.st_size
+    )
+    # copy so callers can't modify the cached result
+    return {name: dict(cutoff) for name, cutoff in cutoffs.items()}
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_cm_file_cached(
+    path_str: str, mtime_ns: int, size: int
+) -> Dict[str, Dict[str, float]]:
+    cutoffs: Dict[str, Dict[str, float]] = {}
+
+    # mmap refuses to map empty files
+    if size == 0:
+        return cutoffs
+
+    last_name = ""
+    last_cutoff = {
+        "GA": 0.0,
+        "TC": 0.0,
+        "NC": 0.0,
+    }
+
+    # scan the whole file with a single regex rather than checking each line in Python
+    with open(path_str, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buf:
+        for match in _CM_FIELD_PATTERN.finditer(buf):
+            record_start, name, cutoff_type, value = match.groups()
+            if record_start:
                 if last_name:
                     cutoffs[last_name] = last_cutoff
 
@@ -48,22 +81,50 @@ def parse_cm_file(path: Path) -> Dict[str, Dict[str, float]]:
                     "TC": 0.0,
                     "NC": 0.0,
                 }
-            elif line.startswith("NAME"):
-                last_name = line.split()[1]
-            elif line.startswith("GA"):
-                last_cutoff["GA"] = float(line.split()[1])
-            elif line.startswith("TC"):
-                last_cutoff["TC"] = float(line.split()[1])
-            elif line.startswith("NC"):
-                last_cutoff["NC"] = float(line.split()[1])
-
-        # at the end, we need to add the last one
+            elif name:
+                last_name = name.decode()
+            else:
+                last_cutoff[cutoff_type.decode()] = float(value)
+
+    # at the end, we need to add the last one
+    if last_name:
         cutoffs[last_name] = last_cutoff
     return cutoffs
 
 
+def parse_cm_file_series(path: Path, cm_cutoff_type: str = "GA") -> pd.Series:
+    """Parse a CM file and return one type of cutoff for each model, indexed by name."""
+    return pd.Series(
+        {name: cutoff[cm_cutoff_type] for name, cutoff in parse_cm_file(path).items()},
+        name="cutoff",
+        dtype="float32",
+    )
+
+
+def _empty_result(
+    ribozymes: pd.DataFrame, output_tsv: Optional[Path] = None
+) -> Dict[str, Any]:
+    """Return a ribozyme_filter result where no hits are selected.
+
+    If `output_tsv` is given, a header-only TSV is written so that downstream
+    steps (and resumed runs) see the same file as when hits are found.
+    """
+    if output_tsv:
+        ribozymes.iloc[:0].assign(symmetric=pd.Series(dtype="boolean")).to_csv(
+            output_tsv,
+            sep="\t",
+            index=False,
+        )
+    return {
+        "df": ribozymes,
+        "single_mask": np.zeros(ribozymes.shape[0], dtype=bool),
+        "double_mask": np.zeros(ribozymes.shape[0], dtype=bool),
+        "ribozy_mask": np.zeros(ribozymes.shape[0], dtype=bool),
+    }
+
+
 def ribozyme_filter(
-    infernal_tblout: Path,
+    infernal_tblout: Union[Path, IO],
     rnamotif_txt: Path = None,
     rnamotif_name: str = None,
     output_tsv: Optional[Path] = None,
@@ -72,10 +133,18 @@ def ribozyme_filter(
     cm_cutoff_type: Literal["GA", "TC", "NC"] = "GA",
     use_evalue_cutoff: bool = True,
     max_evalue: float = 0.01,
-):
+) -> Dict[str, Any]:
+    """Find viroid-like sequences from Infernal (and optionally RNAmotif) hits.
+
+    Returns a dictionary holding every hit in `df` alongside boolean row masks
+    selecting the hits of sequences with one ribozyme (`single_mask`), with
+    ribozymes on both strands (`double_mask`), and either (`ribozy_mask`).
+    """
+    # infernal_tblout may also be an open stream (e.g. cmsearch writing to a pipe)
     ribozymes = pd.read_csv(
         infernal_tblout,
-        delim_whitespace=True,
+        sep=r"\s+",
+        engine="c",
         comment="#",
         usecols=[0, 1, 2, 7, 8, 9, 14, 15, 16],
         header=None,
@@ -90,6 +159,17 @@ def ribozyme_filter(
             "evalue",
             "inc",
         ],
+        dtype={
+            "seq_id": "string",
+            "accession": "string",
+            "ribozyme": "category",
+            "from": "int32",
+            "to": "int32",
+            "strand": "category",
+            "score": "float32",
+            "evalue": "float64",
+            "inc": "category",
+        },
     )
     if ribozymes.shape[0] > 0:
         logging.info(
@@ -97,107 +177,153 @@ def ribozyme_filter(
         )
     else:
         logging.done("No ribozymes present to analyze.")  # type: ignore
-        return
-
-    cutoffs = parse_cm_file(cm_file) if use_cm_cutoff and cm_file else {}
-
-    rz_plus = set()
-    rz_minus = set()
-    rz_significant = set()
-
-    for rz_name, rz_df in ribozymes.groupby(["ribozyme"]):
+        return _empty_result(ribozymes, output_tsv)
+
+    use_rnamotif = bool(rnamotif_txt and rnamotif_txt.exists())
+    # without any cutoff or RNAmotif hits, nothing can be called a ribozyme
+    if not (use_cm_cutoff or use_evalue_cutoff or use_rnamotif):
+        logging.done("No ribozyme cutoffs enabled, so no ribozymes to analyze.")  # type: ignore
+        return _empty_result(ribozymes, output_tsv)
+
+    cutoffs = (
+        parse_cm_file_series(cm_file, cm_cutoff_type)
+        if use_cm_cutoff and cm_file
+        else None
+    )
 
-        # short circuit if we aren't doing verbose output
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
+    # thresholds are computed once and shared by every mask below
+    # stranded hits need a stricter evalue than the significance cutoff
+    strict_max_evalue = max_evalue ** (0.5 if max_evalue < 1 else 2)
+    evalues = ribozymes["evalue"].values
+    below_max_evalue = evalues < max_evalue
+
+    # short circuit if we aren't doing verbose output
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        per_rz = (
+            pd.Series(below_max_evalue, index=ribozymes.index)
+            .groupby(ribozymes["ribozyme"], observed=True)
+            .agg(["size", "sum"])
+        )
+        for rz_name, (n_seqs, n_significant) in per_rz.iterrows():
             logging.debug(
                 f"Analyzing {rz_name=}. "
-                f"{rz_df.shape[0]} sequences, "
-                f"{rz_df.query(f'evalue < {max_evalue}').shape[0]} significant."
-            )
-
-        # all seqs with ribozymes above cutoffs are counted as significant
-        if use_cm_cutoff and cutoffs:
-            rz_plus.update(
-                rz_df.query(
-                    f"strand == '+' & score > {cutoffs[rz_name][cm_cutoff_type]}"
-                ).seq_id
-            )
-            rz_minus.update(
-                rz_df.query(
-                    f"strand == '-' & score > {cutoffs[rz_name][cm_cutoff_type]}"
-                ).seq_id
-            )
-            # signficant ribozymes are either above cutoff with extra low evalue
-            rz_significant.update(
-                rz_df.query(f"score > {cutoffs[rz_name][cm_cutoff_type]}").seq_id
+                f"{n_seqs} sequences, "
+                f"{n_significant} significant."
             )
 
-        if use_evalue_cutoff:
-            # we will also use the evalue cutoff to determine if a ribozyme is present
-            rz_plus.update(
-                rz_df.query(
-                    f"strand == '+' & evalue < {max_evalue ** (0.5 if max_evalue < 1 else 2)}"
-                ).seq_id
+    # compute every filter as a boolean mask over the whole table at once
+    # rather than querying each ribozyme family separately
+    # strand is categorical, so this maps the two categories and gathers int8 codes
+    strand_sign = ribozymes["strand"].map({"+": 1, "-": -1}).astype("int8").values
+    plus = strand_sign == 1
+    minus = strand_sign == -1
+    plus_hits = np.zeros(ribozymes.shape[0], dtype=bool)
+    minus_hits = np.zeros(ribozymes.shape[0], dtype=bool)
+    significant_hits = np.zeros(ribozymes.shape[0], dtype=bool)
+
+    # all seqs with ribozymes above cutoffs are counted as significant
+    if cutoffs is not None and not cutoffs.empty:
+        # ribozyme is categorical, so align the cutoffs to its categories once
+        # and gather them per row using the category codes
+        rz_cutoffs = cutoffs.reindex(ribozymes["ribozyme"].cat.categories)
+        missing = rz_cutoffs.index[rz_cutoffs.isna()]
+        if len(missing):
+            logging.warning(
+                f"No {cm_cutoff_type} cutoff found in {cm_file} for {', '.join(missing)}. "
+                "Hits to these families will never pass the CM cutoff."
             )
-            rz_minus.update(
-                rz_df.query(
-                    f"strand == '-' & evalue < {max_evalue ** (0.5 if max_evalue < 1 else 2)}"
-                ).seq_id
-            )
-            rz_significant.update(rz_df.query(f"evalue < {max_evalue}").seq_id)
+        score_cutoff = rz_cutoffs.to_numpy(dtype="float32")[
+            ribozymes["ribozyme"].cat.codes.values
+        ]
+        above_cutoff = ribozymes["score"].values > score_cutoff
+        plus_hits |= plus & above_cutoff
+        minus_hits |= minus & above_cutoff
+        # signficant ribozymes are either above cutoff with extra low evalue
+        significant_hits |= above_cutoff
+
+    if use_evalue_cutoff:
+        # we will also use the evalue cutoff to determine if a ribozyme is present
+        strict_evalue = evalues < strict_max_evalue
+        plus_hits |= plus & strict_evalue
+        minus_hits |= minus & strict_evalue
+        significant_hits |= below_max_evalue
 
     # Parse and add RNAmotif hits
-    if rnamotif_txt and rnamotif_txt.exists():
+    if use_rnamotif:
         rnamotifs = pd.read_csv(
             rnamotif_txt,
-            delim_whitespace=True,
+            sep=r"\s+",
+            engine="c",
             comment="#",
             header=None,
             names=["seq_id", "score", "strand", "from_", "length"],
             usecols=[0, 1, 2, 3, 4],
+            dtype={
+                "seq_id": "string",
+                "score": "float32",
+                "strand": "int8",
+                "from_": "int32",
+                "length": "int32",
+            },
         )
-        rz_plus.update(rnamotifs.query("strand == 0").seq_id)
-        rz_minus.update(rnamotifs.query("strand == 1").seq_id)
-        # note that there's no add to rz_significant here
-        # this is since I'm not sure if the RNAmotif hits are significant
+        motif_plus = rnamotifs["strand"].values == 0
 
         # merge the rnamotifs df into the ribozymes df
-        # iterate over rnamotifs
-        for rnamotif in rnamotifs.itertuples(index=False):
-            ribozymes = pd.concat(
-                [
-                    ribozymes,
-                    pd.DataFrame(
-                        [
-                            {
-                                "seq_id": rnamotif.seq_id,
-                                "ribozyme": rnamotif_name,
-                                "strand": "+" if rnamotif.strand == 0 else "-",
-                                "evalue": max_evalue**0.5,
-                                "from": rnamotif.from_,
-                                "to": rnamotif.from_
-                                + (
-                                    rnamotif.length * 1
-                                    if rnamotif.strand == 0
-                                    else -1 * rnamotif.length
-                                ),
-                            }
-                        ]
-                    ),
-                ],
-                ignore_index=True,
-            )
+        ribozymes = pd.concat(
+            [
+                ribozymes,
+                pd.DataFrame(
+                    {
+                        "seq_id": rnamotifs["seq_id"],
+                        "ribozyme": rnamotif_name,
+                        "strand": np.where(motif_plus, "+", "-"),
+                        "evalue": max_evalue**0.5,
+                        "from": rnamotifs["from_"],
+                        "to": rnamotifs["from_"]
+                        + np.where(
+                            motif_plus, rnamotifs["length"], -rnamotifs["length"]
+                        ),
+                    }
+                ),
+            ],
+            ignore_index=True,
+        )
+        plus_hits = np.concatenate([plus_hits, motif_plus])
+        minus_hits = np.concatenate([minus_hits, rnamotifs["strand"].values == 1])
+        # note that there's no add to the significant hits here
+        # this is since I'm not sure if the RNAmotif hits are significant
+        significant_hits = np.concatenate(
+            [significant_hits, np.zeros(rnamotifs.shape[0], dtype=bool)]
+        )
+
+    # weak hits still belong in the output alongside a sequence's strong ones,
+    # so they are kept, but if nothing passed we can stop before grouping
+    if not (plus_hits | minus_hits | significant_hits).any():
+        logging.done("No viroid-like sequences found by ribozyme search.")  # type: ignore
+        return _empty_result(ribozymes, output_tsv)
+
+    # collapse the per-hit masks into per-sequence flags
+    codes, seq_ids = pd.factorize(ribozymes["seq_id"], sort=False)
+    has_plus = np.zeros(len(seq_ids), dtype=bool)
+    has_minus = np.zeros(len(seq_ids), dtype=bool)
+    has_significant = np.zeros(len(seq_ids), dtype=bool)
+    has_plus[codes[plus_hits]] = True
+    has_minus[codes[minus_hits]] = True
+    has_significant[codes[significant_hits]] = True
 
     # any sequence with a ribozyme match (even weaker than cutoff) is counted as significant if there are two
-    double_rz_ids = rz_plus.intersection(rz_minus)
+    is_double = has_plus & has_minus
     # all sequences with a significant ribozyme
-    single_rz_ids = rz_significant.difference(double_rz_ids)
+    is_single = has_significant & ~is_double
+
+    double_rz_ids = seq_ids[is_double]
+    single_rz_ids = seq_ids[is_single]
     # union of the two
-    ribozy_likes_ids = double_rz_ids | single_rz_ids
+    ribozy_likes_ids = seq_ids[is_double | is_single]
 
     if len(ribozy_likes_ids) == 0:
         logging.done("No viroid-like sequences found by ribozyme search.")  # type: ignore
-        return
+        return _empty_result(ribozymes, output_tsv)
 
     logging.done(  # type: ignore
         f"Found {len(ribozy_likes_ids)} viroid-like sequences with ribozymes. "
@@ -206,25 +332,29 @@ def ribozyme_filter(
 
     logging.debug("Generating output dataframes...")
 
-    # add categorical information about how many ribozymes are in the sequence
-    ribozymes.loc[ribozymes["seq_id"].isin(double_rz_ids), "symmetric"] = True
-    ribozymes.loc[ribozymes["seq_id"].isin(single_rz_ids), "symmetric"] = False
+    # broadcast the per-sequence classification back onto each hit
+    double_rows = is_double[codes]
+    single_rows = is_single[codes]
+    ribozy_like_rows = double_rows | single_rows
 
-    single_rzs = ribozymes.loc[ribozymes.seq_id.isin(single_rz_ids)]
-    double_rzs = ribozymes.loc[ribozymes.seq_id.isin(double_rz_ids)]
-    ribozy_likes = ribozymes.loc[ribozymes.seq_id.isin(ribozy_likes_ids)]
+    # add categorical information about how many ribozymes are in the sequence
+    ribozymes["symmetric"] = pd.Series(
+        double_rows, index=ribozymes.index, dtype="boolean"
+    ).where(ribozy_like_rows)
 
-    if ribozy_likes.shape[0] and output_tsv:
-        ribozy_likes.sort_values(by="evalue").to_csv(
+    if output_tsv:
+        ribozymes.loc[ribozy_like_rows].sort_values(by="evalue").to_csv(
             output_tsv,
             sep="\t",
             index=False,
         )
 
+    # return the masks rather than materializing an overlapping copy per class
     return {
-        "single_rzs": single_rzs,
-        "double_rzs": double_rzs,
-        "ribozy_likes": ribozy_likes,
+        "df": ribozymes,
+        "single_mask": single_rows,
+        "double_mask": double_rows,
+        "ribozy_mask": ribozy_like_rows,
     }
 
 